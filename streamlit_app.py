@@ -1,14 +1,25 @@
+import hashlib
+import io
+import re
+from functools import lru_cache
 import streamlit as st
 import pandas as pd
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import folium
-from streamlit_folium import folium_static
-import re
+from streamlit_folium import st_folium
 import plotly.express as px
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
+from geopy.extra.rate_limiter import RateLimiter
+
+GARAGE_COLUMNS = ['Garage Name', 'Location', 'City', 'Postcode', 'Phone', 'Email', 'Website']
+QUERY_CACHE_SIZE = 256
+UPLOAD_CACHE_ENTRIES = 4
+# Page size doubles as the map's marker limit, so every card gets a marker
+RESULTS_PER_PAGE = 10
+MAP_COLUMNS = ['Garage Name', 'Location', 'City', 'Postcode', 'Phone', 'Email']
+POSTCODE_AREA_RE = re.compile(r'([A-Z]{1,2}\d{1,2})', re.IGNORECASE)
 
 class GarageSearchEngine:
     def __init__(self, df):
@@ -19,17 +30,36 @@ class GarageSearchEngine:
     def prepare_data(self):
         """Prepare data for searching"""
         # Create combined text field
-        self.df['search_text'] = self.df.apply(
-            lambda x: f"{x['Garage Name']} {x['Location']} {x['City']} {x['Postcode']}", 
-            axis=1
-        ).str.lower()
+        text_cols = ['Garage Name', 'Location', 'City', 'Postcode']
+        search_text = self.df[text_cols[0]].fillna('').astype(str)
+        for col in text_cols[1:]:
+            search_text = search_text + ' ' + self.df[col].fillna('').astype(str)
+        self.df['search_text'] = search_text.str.lower()
+        
+        # Column arrays used to gather result rows without pandas indexing
+        self._cols = {col: self.df[col].fillna('').to_numpy() for col in GARAGE_COLUMNS}
+        
+        # Case-folded lookup columns reused by every query
+        self._name_lower = np.char.lower(self._cols['Garage Name'].astype(str))
+        postcode_upper = self.df['Postcode'].fillna('').astype(str).str.strip().str.upper()
+        
+        # Row positions bucketed by two-character postcode prefix
+        self._prefix_index = postcode_upper.groupby(postcode_upper.str[:2].to_numpy()).indices
         
         # Initialize TF-IDF
         self.tfidf = TfidfVectorizer(
             ngram_range=(1, 2),
-            stop_words='english'
+            stop_words='english',
+            dtype=np.float32
+        )
+        self.tfidf_matrix = self.tfidf.fit_transform(self.df['search_text']).tocsr()
+        # Transposed once so each query is a single sparse product
+        self.tfidf_matrix_t = self.tfidf_matrix.T.tocsr()
+        
+        # Repeated queries (slider changes, paging) skip the vectorizer
+        self._query_vector = lru_cache(maxsize=QUERY_CACHE_SIZE)(
+            lambda text: self.tfidf.transform([text])
         )
-        self.tfidf_matrix = self.tfidf.fit_transform(self.df['search_text'])
         
     def search(self, query: str, search_type: str, threshold: float = 0.1):
         """Unified search method"""
@@ -44,52 +74,122 @@ class GarageSearchEngine:
 
     def _search_by_name(self, name: str, threshold: float):
         """Search by garage name"""
-        query_vector = self.tfidf.transform([name.lower()])
-        similarity_scores = cosine_similarity(query_vector, self.tfidf_matrix)[0]
-        
-        results_df = self.df.copy()
-        results_df['similarity_score'] = similarity_scores
-        
-        return results_df[
-            (results_df['similarity_score'] >= threshold) |
-            (results_df['Garage Name'].str.lower().str.contains(name.lower(), na=False))
-        ].sort_values('similarity_score', ascending=False)
+        return self._rows(*self._name_matches(name, threshold))
 
     def _search_by_location(self, location: str):
         """Search by location"""
-        query_vector = self.tfidf.transform([location.lower()])
-        similarity_scores = cosine_similarity(query_vector, self.tfidf_matrix)[0]
-        
-        results_df = self.df.copy()
-        results_df['similarity_score'] = similarity_scores
-        return results_df[results_df['similarity_score'] >= 0.1].sort_values('similarity_score', ascending=False)
+        return self._rows(*self._location_matches(location))
 
     def _search_nearby(self, postcode: str):
         """Find nearby garages"""
-        area_match = re.search(r'([A-Z]{1,2}\d{1,2})', postcode.upper())
-        if not area_match:
-            return pd.DataFrame()
-            
-        area_prefix = area_match.group(1)[:2]
-        return self.df[self.df['Postcode'].str.contains(f"^{area_prefix}", case=False, na=False)]
+        return self._rows(self._nearby_matches(postcode))
 
     def _comprehensive_search(self, query: str):
         """Search across all fields"""
-        name_results = self._search_by_name(query, 0.1)
-        location_results = self._search_by_location(query)
-        nearby_results = self._search_nearby(query)
+        name_idx, name_scores = self._name_matches(query, 0.1)
+        location_idx, location_scores = self._location_matches(query)
+        nearby_idx = self._nearby_matches(query)
+        
+        # Merge row positions, keeping first-seen (ranked) order
+        all_idx = np.concatenate([name_idx, location_idx, nearby_idx])
+        all_scores = np.concatenate([
+            name_scores, location_scores, np.full(len(nearby_idx), np.nan)
+        ])
+        _, first = np.unique(all_idx, return_index=True)
+        first.sort()
+        return self._rows(all_idx[first], all_scores[first])
+
+    def _name_matches(self, name: str, threshold: float):
+        """Ranked positions and scores of garages matching a name"""
+        similarity_scores = self._similarity_scores(name)
         
-        all_results = pd.concat([name_results, location_results, nearby_results])
-        return all_results.drop_duplicates(subset=['Garage Name', 'Postcode'])
+        mask = (similarity_scores >= threshold) | (np.char.find(self._name_lower, name.lower()) >= 0)
+        idx = np.nonzero(mask)[0]
+        return self._ranked(idx, similarity_scores[idx])
+
+    def _location_matches(self, location: str):
+        """Ranked positions and scores of garages matching a location"""
+        return self._ranked(*self._sparse_matches(location, 0.1))
+
+    def _nearby_matches(self, postcode: str):
+        """Positions of garages sharing the query's postcode prefix"""
+        area_match = POSTCODE_AREA_RE.search(postcode)
+        if not area_match:
+            return np.empty(0, dtype=np.intp)
+            
+        area_prefix = area_match.group(1).upper()[:2]
+        return self._prefix_index.get(area_prefix, np.empty(0, dtype=np.intp))
+
+    def _query_scores(self, text: str):
+        """Sparse (1, N) row of dot-product similarities for a query"""
+        query_vector = self._query_vector(text.lower())
+        return query_vector @ self.tfidf_matrix_t
+
+    def _similarity_scores(self, text: str):
+        """Dot-product similarity of a query against every garage"""
+        return self._query_scores(text).toarray().ravel()
+
+    def _sparse_matches(self, text: str, threshold: float):
+        """Positions and scores of garages scoring at least a positive threshold"""
+        scores = self._query_scores(text).tocsr()
+        scores.sort_indices()
+        keep = scores.data >= threshold
+        return scores.indices[keep], scores.data[keep]
+
+    @staticmethod
+    def _ranked(idx, scores):
+        """Order positions and scores by descending similarity"""
+        order = np.argsort(-scores, kind='stable')
+        return idx[order], scores[order]
+
+    def _rows(self, idx, similarity_scores=None):
+        """Build a result DataFrame for the given row positions"""
+        rows = pd.DataFrame(
+            {col: values[idx] for col, values in self._cols.items()},
+            index=self.df.index[idx]
+        )
+        if similarity_scores is not None:
+            rows['similarity_score'] = similarity_scores
+        return rows
+
+@st.cache_data(max_entries=UPLOAD_CACHE_ENTRIES)
+def load_csv(data: bytes) -> pd.DataFrame:
+    """Parse uploaded CSV bytes into a DataFrame"""
+    return pd.read_csv(
+        io.BytesIO(data),
+        engine='pyarrow',
+        usecols=GARAGE_COLUMNS,
+        dtype={col: 'string[pyarrow]' for col in GARAGE_COLUMNS}
+    )
+
+@st.cache_resource(max_entries=UPLOAD_CACHE_ENTRIES)
+def load_engine(data: bytes) -> GarageSearchEngine:
+    """Build the search engine once per uploaded file"""
+    return GarageSearchEngine(load_csv(data))
+
+@st.cache_resource
+def get_geocoder() -> RateLimiter:
+    """Shared, rate-limited Nominatim client so its HTTP session is reused"""
+    geolocator = Nominatim(user_agent="garage_search")
+    return RateLimiter(
+        geolocator.geocode,
+        min_delay_seconds=1,
+        max_retries=0,
+        swallow_exceptions=False
+    )
+
+@st.cache_data(persist="disk")
+def _geocode(address):
+    """Geocode an address; timeouts propagate so they are not cached"""
+    location = get_geocoder()(address, timeout=5)
+    if location:
+        return location.latitude, location.longitude
+    return None
 
 def get_coordinates(address):
     """Get coordinates for an address using Nominatim"""
     try:
-        geolocator = Nominatim(user_agent="garage_search")
-        location = geolocator.geocode(address)
-        if location:
-            return location.latitude, location.longitude
-        return None
+        return _geocode(address)
     except GeocoderTimedOut:
         return None
 
@@ -97,7 +197,7 @@ def create_map(df, center_lat=51.5074, center_lon=-0.1278):
     """Create a folium map with garage markers"""
     m = folium.Map(location=[center_lat, center_lon], zoom_start=10)
     
-    for idx, row in df.iterrows():
+    for row in df.to_dict('records'):
         address = f"{row['Location']}, {row['City']}, {row['Postcode']}, UK"
         coords = get_coordinates(address)
         if coords:
@@ -115,6 +215,31 @@ def create_map(df, center_lat=51.5074, center_lon=-0.1278):
     
     return m
 
+def garage_card_html(garage):
+    """HTML card for a single garage record"""
+    website = ""
+    if garage['Website'] not in ('', 'No Website'):
+        website = f"<p>🌐 <a href='{garage['Website']}' target='_blank'>{garage['Website']}</a></p>"
+    return (
+        f'<div class="garage-card">'
+        f"<h3>{garage['Garage Name']}</h3>"
+        f"<p>📍 {garage['Location']}, {garage['City']}, {garage['Postcode']}</p>"
+        f"<p>📞 {garage['Phone']}</p>"
+        f"<p>📧 {garage['Email']}</p>"
+        f"{website}"
+        f"</div>"
+    )
+
+@st.cache_data
+def city_pie_chart(cities: tuple):
+    """Pie chart of result counts per city"""
+    city_dist = pd.Series([city for city in cities if city]).value_counts()
+    return px.pie(
+        values=city_dist.values,
+        names=city_dist.index,
+        title="Distribution by City"
+    )
+
 def main():
     st.set_page_config(page_title="UK Garage Finder", layout="wide")
     
@@ -147,11 +272,17 @@ def main():
         
         if uploaded_file is not None:
             try:
-                df = pd.read_csv(uploaded_file)
-                st.success("File uploaded successfully!")
+                # Initialize search engine with uploaded data (cached across reruns)
+                data = uploaded_file.getvalue()
+                search_engine = load_engine(data)
                 
-                # Initialize search engine with uploaded data
-                search_engine = GarageSearchEngine(df)
+                # A different upload invalidates the saved search and page
+                upload_digest = hashlib.sha256(data).hexdigest()
+                if st.session_state.get('upload_digest') != upload_digest:
+                    st.session_state.pop('active_search', None)
+                    st.session_state.pop('results_page', None)
+                    st.session_state['upload_digest'] = upload_digest
+                st.success("File uploaded successfully!")
                 
                 st.header("Search Options")
                 search_type = st.selectbox(
@@ -182,8 +313,18 @@ def main():
                 - For nearby: Enter a postcode to find garages in the area
                 """)
                 
-                # Main content
+                # Keep the last submitted search so paging reruns can redraw it
                 if search_button and search_query:
+                    st.session_state['active_search'] = (
+                        search_query,
+                        search_type,
+                        threshold if search_type == "By Name" else 0.1
+                    )
+                    st.session_state['results_page'] = 1
+                
+                # Main content
+                if 'active_search' in st.session_state:
+                    active_query, active_type, active_threshold = st.session_state['active_search']
                     with st.spinner("Searching..."):
                         # Convert search type to backend format
                         search_type_map = {
@@ -195,9 +336,9 @@ def main():
                         
                         # Perform search
                         results = search_engine.search(
-                            search_query,
-                            search_type_map[search_type],
-                            threshold if search_type == "By Name" else 0.1
+                            active_query,
+                            search_type_map[active_type],
+                            active_threshold
                         )
                         
                         if len(results) > 0:
@@ -207,41 +348,48 @@ def main():
                             with col1:
                                 st.subheader(f"Found {len(results)} matching garages")
                                 
-                                # Display results in cards
-                                for _, garage in results.iterrows():
-                                    with st.container():
-                                        st.markdown(f"""
-                                        <div class="garage-card">
-                                            <h3>{garage['Garage Name']}</h3>
-                                            <p>📍 {garage['Location']}, {garage['City']}, {garage['Postcode']}</p>
-                                            <p>📞 {garage['Phone']}</p>
-                                            <p>📧 {garage['Email']}</p>
-                                            {"<p>🌐 " + f"<a href='{garage['Website']}' target='_blank'>{garage['Website']}</a></p>" if garage['Website'] != 'No Website' else ""}
-                                        </div>
-                                        """, unsafe_allow_html=True)
+                                page_count = (len(results) - 1) // RESULTS_PER_PAGE + 1
+                                page = st.number_input(
+                                    f"Page (of {page_count})",
+                                    min_value=1,
+                                    max_value=page_count,
+                                    step=1,
+                                    key="results_page"
+                                )
+                                start = (page - 1) * RESULTS_PER_PAGE
+                                results_page = results.iloc[start:start + RESULTS_PER_PAGE]
+                                
+                                # Display results in cards, sent as a single element
+                                st.markdown(
+                                    "".join(garage_card_html(garage) for garage in results_page.to_dict('records')),
+                                    unsafe_allow_html=True
+                                )
                             
                             with col2:
                                 st.subheader("📍 Map View")
-                                # Create and display map
-                                if len(results) > 0:
-                                    sample_address = f"{results.iloc[0]['City']}, UK"
+                                # Create and display map for the current page
+                                if len(results_page) > 0:
+                                    sample_address = f"{results_page.iloc[0]['City']}, UK"
                                     coords = get_coordinates(sample_address)
                                     if coords:
-                                        m = create_map(results[:10], coords[0], coords[1])
-                                        folium_static(m)
+                                        markers = tuple(
+                                            results_page[MAP_COLUMNS].itertuples(index=False, name=None)
+                                        )
+                                        # Built fresh each run; geocoding is cached per address
+                                        st_folium(
+                                            create_map(results_page, coords[0], coords[1]),
+                                            returned_objects=[],
+                                            height=500,
+                                            use_container_width=True,
+                                            key=f"map_{hash(markers)}"
+                                        )
                             
                             # Analytics
                             st.markdown("---")
                             st.subheader("📊 Analytics")
                             
                             # City distribution
-                            city_dist = results['City'].value_counts()
-                            fig = px.pie(
-                                values=city_dist.values,
-                                names=city_dist.index,
-                                title="Distribution by City"
-                            )
-                            st.plotly_chart(fig)
+                            st.plotly_chart(city_pie_chart(tuple(results['City'])))
                             
                         else:
                             st.warning("No garages found matching your search criteria.")